@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-import json
+import orjson
 import threading
 import time
+import queue
 from flask import Flask, request, jsonify
 from flask_socketio import SocketIO, emit
 
@@ -11,19 +12,16 @@ from flask_socketio import SocketIO, emit
 if sys.platform.startswith('win'):
     import codecs
     sys.stdout = codecs.getwriter('utf-8')(sys.stdout.detach())
-import librosa
 import numpy as np
-from scipy.spatial.distance import cosine, euclidean
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-import soundfile as sf
 from mutagen import File
 import hashlib
+import mmap
 from pathlib import Path
 import sqlite3
 from datetime import datetime
 import joblib
-from audio_fingerprint import AudioFingerprinter
+from concurrent.futures import ThreadPoolExecutor
+from audio_fingerprint import AudioFingerprinter, AudioFingerprinterGPU
 from similarity_engine import SimilarityEngine
 from external_apis import ExternalAPIManager
 
@@ -31,11 +29,46 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'songdna_neural_key_2024'
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# Files handed to each library scan worker per dispatch
+SCAN_BATCH_SIZE = 8
+
+# Files fingerprinted per GPU kernel batch
+GPU_BATCH_SIZE = 16
+
+# Song rows written per library scan transaction
+SCAN_FLUSH_SIZE = 500
+
+# File hashes keyed by (path, mtime, size) so unchanged files are not re-read
+_file_hash_cache = {}
+
+# One connection per thread, reused for the life of the process
+_db_local = threading.local()
+
+# Columns added to the songs table since the original schema
+SONG_COLUMN_MIGRATIONS = {
+    'feature_vec': 'BLOB',
+    'mtime': 'REAL',
+    'file_size': 'INTEGER'
+}
+
 # Database setup
+def get_db():
+    """Return this thread's persistent database connection"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect('songdna.db', check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-65536')
+        _db_local.conn = conn
+    return conn
+
 def init_database():
-    conn = sqlite3.connect('songdna.db')
+    conn = get_db()
     cursor = conn.cursor()
     
+    # WAL journaling persists in the database file
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # Songs table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS songs (
@@ -46,7 +79,10 @@ def init_database():
             album TEXT,
             duration REAL,
             file_hash TEXT UNIQUE,
+            mtime REAL,
+            file_size INTEGER,
             fingerprint_data TEXT,
+            feature_vec BLOB,
             mfcc_features TEXT,
             chroma_features TEXT,
             spectral_features TEXT,
@@ -58,6 +94,13 @@ def init_database():
         )
     ''')
     
+    # Add columns introduced after the original schema
+    cursor.execute('PRAGMA table_info(songs)')
+    existing_columns = {row[1] for row in cursor.fetchall()}
+    for column, column_type in SONG_COLUMN_MIGRATIONS.items():
+        if column not in existing_columns:
+            cursor.execute(f'ALTER TABLE songs ADD COLUMN {column} {column_type}')
+    
     # Search history table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS search_history (
@@ -68,13 +111,19 @@ def init_database():
         )
     ''')
     
-    conn.commit()
-    conn.close()
-
+    # Spotify responses cached across sessions
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS spotify_cache (
+            track_id TEXT PRIMARY KEY,
+            payload BLOB,
+            fetched_at INTEGER
+        )
+    ''')
+    
 init_database()
 
 # Initialize components after database
-fingerprinter = AudioFingerprinter()
+fingerprinter = AudioFingerprinterGPU() if AudioFingerprinterGPU.is_available() else AudioFingerprinter()
 similarity_engine = SimilarityEngine()
 api_manager = ExternalAPIManager()
 
@@ -100,8 +149,9 @@ def handle_process_audio(data):
         # Get metadata
         metadata = extract_metadata(file_path)
         
-        # Store in database
+        # Store in database and make it searchable
         store_audio_data(file_path, fingerprint_data, metadata)
+        similarity_engine.add_stored_songs([file_path])
         emit('processing_status', {'stage': 'complete', 'progress': 100})
         
         # Send results back
@@ -129,18 +179,21 @@ def handle_search_similar(data):
         local_results = similarity_engine.search_local(
             source_fingerprint, max_results, threshold
         )
+        emit('partial_results', {'source': 'local', 'results': local_results})
         
         emit('search_status', {'stage': 'external_apis', 'progress': 60})
         
-        # Search external APIs if enabled
+        # Search external APIs if enabled, streaming each API's results as it returns
         external_results = []
         if search_mode in ['online', 'hybrid']:
             external_results = api_manager.search_external(
-                source_fingerprint, max_results
+                source_fingerprint, max_results,
+                on_results=lambda results: emit('partial_results', {'source': 'external', 'results': results}),
+                source_file=data.get('source_file')
             )
         
         # Combine and rank results
-        all_results = combine_and_rank_results(local_results, external_results)
+        all_results = combine_and_rank_results(local_results, external_results, max_results)
         
         # Store search history
         store_search_history(data.get('source_file'), all_results)
@@ -170,17 +223,29 @@ def handle_scan_library(data):
         total_files = len(audio_files)
         processed_files = 0
         
-        for i, file_path in enumerate(audio_files):
+        # Skip files already in the database using one up-front lookup
+        indexed_files = load_indexed_files()
+        pending_files = [f for f in audio_files if not is_file_processed(f, indexed_files)]
+        skipped_files = total_files - len(pending_files)
+        
+        results = fingerprint_files(pending_files)
+        
+        conn = get_db()
+        pending_rows = []
+        
+        for i, (file_path, fingerprint_data, metadata) in enumerate(results):
             try:
-                # Check if already processed
-                if not is_file_processed(file_path):
-                    fingerprint_data = fingerprinter.extract_fingerprint(file_path)
-                    metadata = extract_metadata(file_path)
-                    store_audio_data(file_path, fingerprint_data, metadata)
+                # Database writes stay on this thread, batched per transaction
+                if fingerprint_data is not None:
+                    pending_rows.append(build_song_row(file_path, fingerprint_data, metadata))
                     processed_files += 1
+                    
+                    if len(pending_rows) >= SCAN_FLUSH_SIZE:
+                        store_and_index_batch(conn, pending_rows)
+                        pending_rows = []
                 
                 # Update progress
-                progress = int((i + 1) / total_files * 100)
+                progress = int((skipped_files + i + 1) / total_files * 100)
                 emit('scan_status', {
                     'stage': 'processing',
                     'progress': progress,
@@ -193,6 +258,12 @@ def handle_scan_library(data):
                 print(f"Error processing {file_path}: {str(e)}")
                 continue
         
+        if pending_rows:
+            store_and_index_batch(conn, pending_rows)
+        
+        # Keep the persisted index in step with the database for the next startup
+        similarity_engine.save_index()
+        
         emit('scan_complete', {
             'total_processed': processed_files,
             'total_files': total_files
@@ -202,8 +273,58 @@ def handle_scan_library(data):
         print(f"Error scanning library: {str(e)}")
         emit('error', {'message': f'Library scan error: {str(e)}'})
 
+def fingerprint_files(file_paths):
+    """Fingerprint files for the library, yielding (file_path, fingerprint, metadata) in order"""
+    if isinstance(fingerprinter, AudioFingerprinterGPU):
+        # Batch files through the GPU from this process
+        return _process_gpu_batches(file_paths)
+    
+    # Fingerprint in parallel worker processes; results stream back in order
+    return joblib.Parallel(
+        n_jobs=os.cpu_count(),
+        prefer='processes',
+        batch_size=SCAN_BATCH_SIZE,
+        return_as='generator'
+    )(joblib.delayed(_process_one)(file_path) for file_path in file_paths)
+
+def _process_one(file_path):
+    """Fingerprint a single file for a library scan (runs in a worker process)"""
+    try:
+        # Parse tags on a helper thread while this process fingerprints
+        with ThreadPoolExecutor(max_workers=1) as io_pool:
+            metadata_future = io_pool.submit(extract_metadata, file_path)
+            fingerprint_data = fingerprinter.extract_fingerprint(file_path)
+            metadata = metadata_future.result()
+        return file_path, fingerprint_data, metadata
+    except Exception as e:
+        print(f"Error processing {file_path}: {str(e)}")
+        return file_path, None, None
+
+def _process_gpu_batches(file_paths):
+    """Fingerprint files for a library scan in GPU-sized batches"""
+    with ThreadPoolExecutor(max_workers=4) as io_pool:
+        for start in range(0, len(file_paths), GPU_BATCH_SIZE):
+            batch = file_paths[start:start + GPU_BATCH_SIZE]
+            
+            # Parse tags on helper threads while the GPU works on the batch
+            metadata_futures = [io_pool.submit(extract_metadata, file_path) for file_path in batch]
+            try:
+                fingerprints = fingerprinter.extract_fingerprint_batch(batch)
+            except Exception as e:
+                print(f"Error processing batch: {str(e)}")
+                fingerprints = [None] * len(batch)
+            
+            for file_path, fingerprint_data, metadata_future in zip(batch, fingerprints, metadata_futures):
+                metadata = metadata_future.result() if fingerprint_data is not None else None
+                yield file_path, fingerprint_data, metadata
+
 def extract_metadata(file_path):
     """Extract metadata from audio file"""
+    try:
+        file_size = os.stat(file_path).st_size
+    except OSError:
+        file_size = 0
+    
     try:
         # Get file info using mutagen
         audio_file = File(file_path)
@@ -212,7 +333,7 @@ def extract_metadata(file_path):
             'artist': 'Unknown',
             'album': 'Unknown',
             'duration': 0,
-            'file_size': os.path.getsize(file_path)
+            'file_size': file_size
         }
         
         if audio_file:
@@ -233,126 +354,221 @@ def extract_metadata(file_path):
             'artist': 'Unknown',
             'album': 'Unknown',
             'duration': 0,
-            'file_size': os.path.getsize(file_path) if os.path.exists(file_path) else 0
+            'file_size': file_size
         }
 
+def build_song_row(file_path, fingerprint_data, metadata):
+    """Build the songs table row for an audio file"""
+    # Calculate file hash and the stat signature used to skip rescans
+    stat = os.stat(file_path)
+    file_hash = calculate_file_hash(file_path, stat)
+    
+    # Pack the flat feature vector as raw float32 bytes
+    feature_vec = fingerprinter.create_feature_vector(fingerprint_data).astype(np.float32)
+    
+    return (
+        file_path,
+        metadata['title'],
+        metadata['artist'],
+        metadata['album'],
+        metadata['duration'],
+        file_hash,
+        stat.st_mtime,
+        stat.st_size,
+        sqlite3.Binary(feature_vec.tobytes()),
+        fingerprint_data.get('tempo', 0),
+        fingerprint_data.get('key', 'Unknown'),
+        fingerprint_data.get('energy', 0),
+        datetime.now().isoformat()
+    )
+
+def store_audio_data_batch(conn, rows):
+    """Store a batch of song rows in a single transaction"""
+    try:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+        cursor.executemany('''
+            INSERT OR REPLACE INTO songs 
+            (file_path, title, artist, album, duration, file_hash, mtime, file_size, 
+             feature_vec, tempo, key_signature, energy, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        cursor.execute('COMMIT')
+        
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        print(f"Error storing audio data batch: {str(e)}")
+
+def store_and_index_batch(conn, rows):
+    """Store a batch of song rows and add them to the in-memory search index"""
+    store_audio_data_batch(conn, rows)
+    similarity_engine.add_stored_songs([row[0] for row in rows])
+
 def store_audio_data(file_path, fingerprint_data, metadata):
     """Store audio fingerprint and metadata in database"""
     try:
-        # Calculate file hash
-        file_hash = calculate_file_hash(file_path)
+        row = build_song_row(file_path, fingerprint_data, metadata)
         
-        conn = sqlite3.connect('songdna.db')
-        cursor = conn.cursor()
-        
-        # Convert numpy arrays to JSON strings
-        fingerprint_json = json.dumps({
-            'mfcc': fingerprint_data['mfcc'].tolist() if 'mfcc' in fingerprint_data else [],
-            'chroma': fingerprint_data['chroma'].tolist() if 'chroma' in fingerprint_data else [],
-            'spectral_centroids': fingerprint_data['spectral_centroids'].tolist() if 'spectral_centroids' in fingerprint_data else [],
-            'spectral_rolloff': fingerprint_data['spectral_rolloff'].tolist() if 'spectral_rolloff' in fingerprint_data else [],
-            'zero_crossing_rate': fingerprint_data['zero_crossing_rate'].tolist() if 'zero_crossing_rate' in fingerprint_data else [],
-            'tempo': fingerprint_data.get('tempo', 0),
-            'key': fingerprint_data.get('key', 'Unknown'),
-            'energy': fingerprint_data.get('energy', 0)
-        })
-        
-        cursor.execute('''
-            INSERT OR REPLACE INTO songs 
-            (file_path, title, artist, album, duration, file_hash, fingerprint_data, 
-             tempo, key_signature, energy, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            file_path,
-            metadata['title'],
-            metadata['artist'],
-            metadata['album'],
-            metadata['duration'],
-            file_hash,
-            fingerprint_json,
-            fingerprint_data.get('tempo', 0),
-            fingerprint_data.get('key', 'Unknown'),
-            fingerprint_data.get('energy', 0),
-            datetime.now().isoformat()
-        ))
-        
-        conn.commit()
-        conn.close()
+        store_audio_data_batch(get_db(), [row])
         
     except Exception as e:
         print(f"Error storing audio data: {str(e)}")
 
-def calculate_file_hash(file_path):
+def calculate_file_hash(file_path, stat=None):
     """Calculate SHA256 hash of file"""
-    hasher = hashlib.sha256()
+    stat = stat or os.stat(file_path)
+    cache_key = (file_path, stat.st_mtime, stat.st_size)
+    if cache_key in _file_hash_cache:
+        return _file_hash_cache[cache_key]
+    
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hasher.update(chunk)
-    return hasher.hexdigest()
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+: hashed in C with the GIL released
+            file_hash = hashlib.file_digest(f, 'sha256').hexdigest()
+        else:
+            hasher = hashlib.sha256()
+            if stat.st_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    hasher.update(mapped)
+            file_hash = hasher.hexdigest()
+    
+    _file_hash_cache[cache_key] = file_hash
+    return file_hash
 
-def is_file_processed(file_path):
+def load_indexed_files():
+    """Load the stat signatures and hashes of all files already stored in the database"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT file_path, mtime, file_size, file_hash FROM songs WHERE feature_vec IS NOT NULL')
+        file_stats = {}
+        file_hashes = {}
+        for file_path, mtime, file_size, file_hash in cursor.fetchall():
+            file_stats[file_path] = (mtime, file_size)
+            file_hashes[file_hash] = file_path
+        return file_stats, file_hashes
+    except Exception as e:
+        print(f"Error loading indexed files: {str(e)}")
+        return {}, {}
+
+def update_file_stat(file_path, stat):
+    """Record the current mtime and size of a touched file whose content is unchanged"""
+    get_db().execute('UPDATE songs SET mtime = ?, file_size = ? WHERE file_path = ?',
+                     (stat.st_mtime, stat.st_size, file_path))
+
+def is_file_processed(file_path, indexed_files=None):
     """Check if file is already processed"""
     try:
-        file_hash = calculate_file_hash(file_path)
-        conn = sqlite3.connect('songdna.db')
+        stat = os.stat(file_path)
+        file_stat = (stat.st_mtime, stat.st_size)
+        
+        if indexed_files is not None:
+            file_stats, file_hashes = indexed_files
+            
+            # Unchanged file at a known path: skip without reading it
+            if file_stats.get(file_path) == file_stat:
+                return True
+            
+            # New or changed path: hash only to detect duplicate content
+            stored_path = file_hashes.get(calculate_file_hash(file_path, stat))
+            if stored_path == file_path:
+                update_file_stat(file_path, stat)
+            return stored_path is not None
+        
+        conn = get_db()
         cursor = conn.cursor()
-        cursor.execute('SELECT id FROM songs WHERE file_hash = ?', (file_hash,))
+        cursor.execute('SELECT mtime, file_size FROM songs WHERE file_path = ? AND feature_vec IS NOT NULL', (file_path,))
         result = cursor.fetchone()
-        conn.close()
+        
+        if result is None or tuple(result) != file_stat:
+            file_hash = calculate_file_hash(file_path, stat)
+            cursor.execute('SELECT file_path FROM songs WHERE file_hash = ? AND feature_vec IS NOT NULL', (file_hash,))
+            result = cursor.fetchone()
+            if result is not None and result[0] == file_path:
+                update_file_stat(file_path, stat)
+        
         return result is not None
     except:
         return False
 
-def combine_and_rank_results(local_results, external_results):
+def combine_and_rank_results(local_results, external_results, max_results=None):
     """Combine and rank results from different sources"""
-    all_results = []
+    # Each search tags its own results with their source
+    all_results = local_results + external_results
+    if not all_results:
+        return []
     
-    # Add local results
-    for result in local_results:
-        result['source'] = 'local'
-        all_results.append(result)
+    # Select the top results by similarity score (descending)
+    scores = np.fromiter((result.get('similarity', 0.0) for result in all_results),
+                         dtype=np.float32, count=len(all_results))
+    k = len(scores) if max_results is None else max(0, min(len(scores), max_results))
+    if k == 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
     
-    # Add external results
-    for result in external_results:
-        result['source'] = 'external'
-        all_results.append(result)
-    
-    # Sort by similarity score (descending)
-    all_results.sort(key=lambda x: x.get('similarity', 0), reverse=True)
-    
-    return all_results
+    return [all_results[i] for i in top]
+
+# Search history is written behind the socket handlers by one thread
+HISTORY_BATCH_SIZE = 64
+HISTORY_FLUSH_INTERVAL = 0.1  # seconds
+_history_queue = queue.Queue()
 
 def store_search_history(source_file, results):
-    """Store search history in database"""
-    try:
-        conn = sqlite3.connect('songdna.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO search_history (source_file, results)
-            VALUES (?, ?)
-        ''', (source_file, json.dumps(results)))
-        
-        conn.commit()
-        conn.close()
+    """Queue search history for the background writer"""
+    _history_queue.put((source_file, results))
+
+def _history_writer():
+    """Write queued search history to the database in batches"""
+    while True:
+        # Wait for one entry, then collect whatever arrives within the flush interval
+        batch = [_history_queue.get()]
+        deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+        while len(batch) < HISTORY_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_history_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
         
-    except Exception as e:
-        print(f"Error storing search history: {str(e)}")
+        rows = []
+        for source_file, results in batch:
+            try:
+                rows.append((source_file, orjson.dumps(results, option=orjson.OPT_SERIALIZE_NUMPY).decode()))
+            except Exception as e:
+                print(f"Error encoding search history: {str(e)}")
+        
+        conn = get_db()
+        try:
+            conn.execute('BEGIN')
+            conn.executemany('''
+                INSERT INTO search_history (source_file, results)
+                VALUES (?, ?)
+            ''', rows)
+            conn.execute('COMMIT')
+            
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            print(f"Error storing search history: {str(e)}")
+
+threading.Thread(target=_history_writer, daemon=True).start()
 
 @app.route('/library/stats')
 def get_library_stats():
     """Get library statistics"""
     try:
-        conn = sqlite3.connect('songdna.db')
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT COUNT(*) FROM songs')
         total_songs = cursor.fetchone()[0]
         
-        cursor.execute('SELECT SUM(LENGTH(fingerprint_data)) FROM songs WHERE fingerprint_data IS NOT NULL')
-        indexed_count = cursor.fetchone()[0] or 0
-        
-        conn.close()
+        cursor.execute('SELECT COUNT(*) FROM songs WHERE feature_vec IS NOT NULL')
+        indexed_count = cursor.fetchone()[0]
         
         return jsonify({
             'total_songs': total_songs,
@@ -363,10 +579,54 @@ def get_library_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def migrate_legacy_fingerprints():
+    """Re-fingerprint songs stored only as JSON so they are saved as packed feature vectors"""
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT file_path FROM songs WHERE feature_vec IS NULL AND fingerprint_data IS NOT NULL')
+        legacy_files = [row[0] for row in cursor.fetchall()]
+        
+        # The JSON holds only part of the feature layout, so the audio is analysed again
+        present_files = [f for f in legacy_files if os.path.exists(f)]
+        migrated_files = 0
+        pending_rows = []
+        
+        for file_path, fingerprint_data, metadata in fingerprint_files(present_files):
+            if fingerprint_data is None:
+                continue
+            
+            # Replacing the row by file_path drops its JSON fingerprint
+            pending_rows.append(build_song_row(file_path, fingerprint_data, metadata))
+            migrated_files += 1
+            
+            if len(pending_rows) >= SCAN_FLUSH_SIZE:
+                store_audio_data_batch(conn, pending_rows)
+                pending_rows = []
+        
+        if pending_rows:
+            store_audio_data_batch(conn, pending_rows)
+        
+        print(f"Migrated {migrated_files} of {len(legacy_files)} legacy fingerprints "
+              f"({len(legacy_files) - len(present_files)} files missing)")
+        
+        if migrated_files:
+            similarity_engine.rebuild_index()
+        
+    except Exception as e:
+        print(f"Error migrating legacy fingerprints: {str(e)}")
+
 if __name__ == '__main__':
+    if '--migrate-fingerprints' in sys.argv:
+        migrate_legacy_fingerprints()
+        sys.exit(0)
+    
     print("SongDNA Neural Backend Starting...")
     print("Audio fingerprinting engine online")
     print("Similarity search ready")
     print("Listening on http://localhost:5001")
     
-    socketio.run(app, host='localhost', port=5001, debug=False)
\ No newline at end of file
+    try:
+        socketio.run(app, host='localhost', port=5001, debug=False)
+    finally:
+        similarity_engine.save_index()
\ No newline at end of file
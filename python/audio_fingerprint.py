@@ -1,113 +1,91 @@
 import librosa
 import numpy as np
-from scipy import signal
-from scipy.stats import mode
-import librosa.display
-from sklearn.preprocessing import StandardScaler
+import soundfile as sf
+import soxr
+import threading
 import warnings
 warnings.filterwarnings('ignore')
 
+# Optional GPU backend
+try:
+    import torch
+    import torchaudio
+except ImportError:
+    torch = None
+    torchaudio = None
+
+def _build_key_profiles():
+    """Build the 24 rotated key profiles, mean-centered and unit-normalized"""
+    # Major and minor key profiles (Krumhansl-Schmuckler)
+    major_profile = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
+    minor_profile = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
+    
+    # Rows 0-11 are major keys, rows 12-23 minor keys
+    profiles = np.array([np.roll(major_profile, i) for i in range(12)] +
+                        [np.roll(minor_profile, i) for i in range(12)])
+    profiles = profiles - profiles.mean(axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+# Flat feature vector layout: scalar features first, then array features
+SCALAR_FEATURES = [
+    'spectral_centroids', 'spectral_centroids_std',
+    'spectral_rolloff', 'spectral_rolloff_std',
+    'zero_crossing_rate', 'zero_crossing_rate_std',
+    'spectral_bandwidth', 'spectral_bandwidth_std',
+    'tempo', 'onset_strength', 'onset_strength_std',
+    'harmonic_energy', 'percussive_energy', 'harmonic_percussive_ratio',
+    'rms_energy', 'rms_energy_std', 'dynamic_range',
+    'mel_spectral_mean', 'mel_spectral_std', 'energy'
+]
+
+ARRAY_FEATURES = ['mfcc', 'mfcc_std', 'chroma', 'chroma_std', 
+                  'spectral_contrast', 'spectral_contrast_std', 
+                  'tonnetz', 'tonnetz_std']
+
+def build_feature_layout(n_mfcc=13):
+    """Build the (feature, offset, size) layout of the flat feature vector"""
+    sizes = {
+        'mfcc': n_mfcc, 'mfcc_std': n_mfcc,
+        'chroma': 12, 'chroma_std': 12,
+        'spectral_contrast': 7, 'spectral_contrast_std': 7,
+        'tonnetz': 6, 'tonnetz_std': 6
+    }
+    
+    layout = []
+    offset = 0
+    for feature in SCALAR_FEATURES + ARRAY_FEATURES:
+        size = sizes.get(feature, 1)
+        layout.append((feature, offset, size))
+        offset += size
+    
+    return layout, offset
+
+KEY_NAMES = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
+KEY_LABELS = [f"{name} major" for name in KEY_NAMES] + [f"{name} minor" for name in KEY_NAMES]
+KEY_PROFILES = _build_key_profiles()
+
+# One-second padding buffer for short clips, one per thread so concurrent loads never share it
+_pad_buffers = threading.local()
+
 class AudioFingerprinter:
     """Advanced audio fingerprinting using multiple spectral features"""
     
-    def __init__(self, sr=22050, hop_length=512, n_mfcc=13):
+    def __init__(self, sr=22050, hop_length=512, n_mfcc=13, n_fft=2048):
         self.sr = sr
         self.hop_length = hop_length
         self.n_mfcc = n_mfcc
-        self.scaler = StandardScaler()
+        self.n_fft = n_fft
+        self.feature_layout, self.feature_dim = build_feature_layout(n_mfcc)
+        self._energy_weights = self._build_energy_weights()
         
     def extract_fingerprint(self, file_path):
         """Extract comprehensive audio fingerprint"""
         try:
-            # Load audio file
-            y, sr = librosa.load(file_path, sr=self.sr)
-            
-            # Ensure we have enough samples
-            if len(y) < self.sr:  # Less than 1 second
-                y = np.pad(y, (0, self.sr - len(y)), mode='constant')
-            
-            fingerprint = {}
-            
-            # 1. MFCC Features (Mel-frequency cepstral coefficients)
-            mfcc = librosa.feature.mfcc(y=y, sr=sr, n_mfcc=self.n_mfcc, hop_length=self.hop_length)
-            fingerprint['mfcc'] = np.mean(mfcc, axis=1)  # Average across time
-            fingerprint['mfcc_std'] = np.std(mfcc, axis=1)  # Standard deviation
-            
-            # 2. Chroma Features (Pitch class profiles)
-            chroma = librosa.feature.chroma_stft(y=y, sr=sr, hop_length=self.hop_length)
-            fingerprint['chroma'] = np.mean(chroma, axis=1)
-            fingerprint['chroma_std'] = np.std(chroma, axis=1)
-            
-            # 3. Spectral Features
-            # Spectral centroid (brightness)
-            spectral_centroids = librosa.feature.spectral_centroid(y=y, sr=sr, hop_length=self.hop_length)[0]
-            fingerprint['spectral_centroids'] = np.mean(spectral_centroids)
-            fingerprint['spectral_centroids_std'] = np.std(spectral_centroids)
-            
-            # Spectral rolloff
-            spectral_rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr, hop_length=self.hop_length)[0]
-            fingerprint['spectral_rolloff'] = np.mean(spectral_rolloff)
-            fingerprint['spectral_rolloff_std'] = np.std(spectral_rolloff)
-            
-            # Zero crossing rate
-            zcr = librosa.feature.zero_crossing_rate(y, hop_length=self.hop_length)[0]
-            fingerprint['zero_crossing_rate'] = np.mean(zcr)
-            fingerprint['zero_crossing_rate_std'] = np.std(zcr)
-            
-            # Spectral bandwidth
-            spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr, hop_length=self.hop_length)[0]
-            fingerprint['spectral_bandwidth'] = np.mean(spectral_bandwidth)
-            fingerprint['spectral_bandwidth_std'] = np.std(spectral_bandwidth)
-            
-            # 4. Rhythm and Tempo Features
-            tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr, hop_length=self.hop_length)
-            fingerprint['tempo'] = float(tempo)
-            
-            # Beat strength
-            onset_envelope = librosa.onset.onset_strength(y=y, sr=sr, hop_length=self.hop_length)
-            fingerprint['onset_strength'] = np.mean(onset_envelope)
-            fingerprint['onset_strength_std'] = np.std(onset_envelope)
-            
-            # 5. Harmonic and Percussive Separation
-            y_harmonic, y_percussive = librosa.effects.hpss(y)
-            
-            # Harmonic energy
-            fingerprint['harmonic_energy'] = np.sum(y_harmonic ** 2)
-            fingerprint['percussive_energy'] = np.sum(y_percussive ** 2)
-            fingerprint['harmonic_percussive_ratio'] = fingerprint['harmonic_energy'] / (fingerprint['percussive_energy'] + 1e-10)
+            y = self._load_audio(file_path)
+            S, mel_spec, chroma = self._compute_spectrograms(y, self.sr)
             
-            # 6. Key and Tonality
-            chroma_cq = librosa.feature.chroma_cqt(y=y, sr=sr)
-            key = self.estimate_key(chroma_cq)
-            fingerprint['key'] = key
-            
-            # 7. Energy and Dynamics
-            # RMS energy
-            rms = librosa.feature.rms(y=y, hop_length=self.hop_length)[0]
-            fingerprint['rms_energy'] = np.mean(rms)
-            fingerprint['rms_energy_std'] = np.std(rms)
-            
-            # Dynamic range
-            fingerprint['dynamic_range'] = np.max(rms) - np.min(rms)
-            
-            # 8. Mel Spectrogram Features
-            mel_spec = librosa.feature.melspectrogram(y=y, sr=sr, hop_length=self.hop_length)
-            mel_spec_db = librosa.power_to_db(mel_spec, ref=np.max)
-            fingerprint['mel_spectral_mean'] = np.mean(mel_spec_db)
-            fingerprint['mel_spectral_std'] = np.std(mel_spec_db)
-            
-            # 9. Contrast Features
-            contrast = librosa.feature.spectral_contrast(y=y, sr=sr, hop_length=self.hop_length)
-            fingerprint['spectral_contrast'] = np.mean(contrast, axis=1)
-            fingerprint['spectral_contrast_std'] = np.std(contrast, axis=1)
-            
-            # 10. Tonnetz (Tonal centroid features)
-            tonnetz = librosa.feature.tonnetz(y=librosa.effects.harmonic(y), sr=sr)
-            fingerprint['tonnetz'] = np.mean(tonnetz, axis=1)
-            fingerprint['tonnetz_std'] = np.std(tonnetz, axis=1)
-            
-            # Overall energy
-            fingerprint['energy'] = float(np.sum(y ** 2) / len(y))
+            fingerprint = self._extract_spectral_features(S, mel_spec, chroma, self.sr)
+            fingerprint.update(self._extract_signal_features(y, S, mel_spec, chroma, self.sr))
             
             return fingerprint
             
@@ -115,42 +93,169 @@ class AudioFingerprinter:
             print(f"Error extracting fingerprint from {file_path}: {str(e)}")
             return self._get_empty_fingerprint()
     
+    def extract_fingerprint_batch(self, file_paths):
+        """Extract fingerprints for several audio files"""
+        return [self.extract_fingerprint(file_path) for file_path in file_paths]
+    
+    def _load_audio(self, file_path, reuse_buffer=True):
+        """Load an audio file as a mono signal at the fingerprint sample rate"""
+        # Load audio file
+        try:
+            y, native_sr = sf.read(file_path, dtype='float32', always_2d=False)
+            if y.ndim > 1:
+                y = y.mean(axis=1)  # Downmix to mono
+            if native_sr != self.sr:
+                y = soxr.resample(y, native_sr, self.sr, quality='HQ')
+        except RuntimeError:
+            # Formats libsndfile cannot decode (e.g. m4a/aac) go through audioread
+            y, sr = librosa.load(file_path, sr=self.sr)
+        
+        # Ensure we have enough samples
+        if len(y) < self.sr:  # Less than 1 second
+            # A reused buffer is only valid until the next load on the same thread
+            if not reuse_buffer:
+                return np.pad(y, (0, self.sr - len(y)), mode='constant')
+            
+            pad_buffer = getattr(_pad_buffers, 'buffer', None)
+            if pad_buffer is None or len(pad_buffer) != self.sr:
+                pad_buffer = _pad_buffers.buffer = np.zeros(self.sr, dtype=np.float32)
+            pad_buffer[:len(y)] = y
+            pad_buffer[len(y):] = 0
+            y = pad_buffer
+        
+        return y
+    
+    def _build_energy_weights(self):
+        """Per-bin weights mapping a one-sided magnitude STFT to time-domain energy (Parseval)"""
+        window = librosa.filters.get_window('hann', self.n_fft, fftbins=True)
+        weights = np.full(self.n_fft // 2 + 1, 2.0)
+        weights[0] = 1.0
+        if self.n_fft % 2 == 0:
+            weights[-1] = 1.0
+        # Overlapping frames count each sample sum(w^2) / hop times
+        return weights * self.hop_length / (self.n_fft * np.sum(window ** 2))
+    
+    def _spectral_energy(self, S):
+        """Time-domain energy of the signal behind a magnitude STFT"""
+        return float(self._energy_weights @ np.sum(S ** 2, axis=1))
+    
+    def _compute_spectrograms(self, y, sr):
+        """Compute the magnitude STFT once, plus the mel spectrogram and chroma built from it"""
+        S = np.abs(librosa.stft(y, n_fft=self.n_fft, hop_length=self.hop_length))
+        S_power = S ** 2
+        mel_spec = librosa.feature.melspectrogram(S=S_power, sr=sr)
+        chroma = librosa.feature.chroma_stft(S=S_power, sr=sr)
+        return S, mel_spec, chroma
+    
+    def _extract_spectral_features(self, S, mel_spec, chroma, sr):
+        """Extract the features derived from the short-time spectrum"""
+        fingerprint = {}
+        
+        # 1. MFCC Features (Mel-frequency cepstral coefficients)
+        mfcc = librosa.feature.mfcc(S=librosa.power_to_db(mel_spec), n_mfcc=self.n_mfcc)
+        fingerprint['mfcc'] = np.mean(mfcc, axis=1)  # Average across time
+        fingerprint['mfcc_std'] = np.std(mfcc, axis=1)  # Standard deviation
+        
+        # 2. Chroma Features (Pitch class profiles)
+        fingerprint['chroma'] = np.mean(chroma, axis=1)
+        fingerprint['chroma_std'] = np.std(chroma, axis=1)
+        
+        # 3. Spectral Features
+        # Spectral centroid (brightness)
+        spectral_centroids = librosa.feature.spectral_centroid(S=S, sr=sr, n_fft=self.n_fft)[0]
+        fingerprint['spectral_centroids'] = np.mean(spectral_centroids)
+        fingerprint['spectral_centroids_std'] = np.std(spectral_centroids)
+        
+        # Spectral rolloff
+        spectral_rolloff = librosa.feature.spectral_rolloff(S=S, sr=sr, n_fft=self.n_fft)[0]
+        fingerprint['spectral_rolloff'] = np.mean(spectral_rolloff)
+        fingerprint['spectral_rolloff_std'] = np.std(spectral_rolloff)
+        
+        # Spectral bandwidth
+        spectral_bandwidth = librosa.feature.spectral_bandwidth(S=S, sr=sr, n_fft=self.n_fft)[0]
+        fingerprint['spectral_bandwidth'] = np.mean(spectral_bandwidth)
+        fingerprint['spectral_bandwidth_std'] = np.std(spectral_bandwidth)
+        
+        # 8. Mel Spectrogram Features
+        mel_spec_db = librosa.power_to_db(mel_spec, ref=np.max)
+        fingerprint['mel_spectral_mean'] = np.mean(mel_spec_db)
+        fingerprint['mel_spectral_std'] = np.std(mel_spec_db)
+        
+        return fingerprint
+    
+    def _extract_signal_features(self, y, S, mel_spec, chroma, sr):
+        """Extract rhythm, harmonic, tonal and energy features"""
+        fingerprint = {}
+        
+        # Zero crossing rate
+        zcr = librosa.feature.zero_crossing_rate(y, hop_length=self.hop_length)[0]
+        fingerprint['zero_crossing_rate'] = np.mean(zcr)
+        fingerprint['zero_crossing_rate_std'] = np.std(zcr)
+        
+        # 4. Rhythm and Tempo Features
+        # Onset envelope from the shared log-mel spectrogram drives beat tracking too
+        onset_envelope = librosa.onset.onset_strength(S=librosa.power_to_db(mel_spec), sr=sr, hop_length=self.hop_length)
+        tempo, beat_frames = librosa.beat.beat_track(onset_envelope=onset_envelope, sr=sr, hop_length=self.hop_length)
+        fingerprint['tempo'] = float(tempo)
+        
+        # Beat strength
+        fingerprint['onset_strength'] = np.mean(onset_envelope)
+        fingerprint['onset_strength_std'] = np.std(onset_envelope)
+        
+        # 5. Harmonic and Percussive Separation
+        # Energies come straight from the masked magnitudes, no inverse STFT needed
+        H, P = librosa.decompose.hpss(S, margin=1.0)
+        
+        # Harmonic energy
+        fingerprint['harmonic_energy'] = self._spectral_energy(H)
+        fingerprint['percussive_energy'] = self._spectral_energy(P)
+        fingerprint['harmonic_percussive_ratio'] = fingerprint['harmonic_energy'] / (fingerprint['percussive_energy'] + 1e-10)
+        
+        # 6. Key and Tonality
+        # The STFT chroma is close enough for the Krumhansl-Schmuckler profiles
+        key = self.estimate_key(chroma)
+        fingerprint['key'] = key
+        
+        # 7. Energy and Dynamics
+        # RMS energy
+        rms = librosa.feature.rms(y=y, hop_length=self.hop_length)[0]
+        fingerprint['rms_energy'] = np.mean(rms)
+        fingerprint['rms_energy_std'] = np.std(rms)
+        
+        # Dynamic range
+        fingerprint['dynamic_range'] = np.max(rms) - np.min(rms)
+        
+        # 9. Contrast Features
+        contrast = librosa.feature.spectral_contrast(S=S, sr=sr, n_fft=self.n_fft)
+        fingerprint['spectral_contrast'] = np.mean(contrast, axis=1)
+        fingerprint['spectral_contrast_std'] = np.std(contrast, axis=1)
+        
+        # 10. Tonnetz (Tonal centroid features)
+        tonnetz = librosa.feature.tonnetz(sr=sr, chroma=chroma)
+        fingerprint['tonnetz'] = np.mean(tonnetz, axis=1)
+        fingerprint['tonnetz_std'] = np.std(tonnetz, axis=1)
+        
+        # Overall energy
+        fingerprint['energy'] = float(np.sum(y ** 2) / len(y))
+        
+        return fingerprint
+    
     def estimate_key(self, chroma):
         """Estimate musical key from chroma features"""
         try:
-            # Major and minor key profiles (Krumhansl-Schmuckler)
-            major_profile = np.array([6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88])
-            minor_profile = np.array([6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17])
-            
             # Average chroma across time
             chroma_mean = np.mean(chroma, axis=1)
             
-            # Normalize
-            chroma_mean = chroma_mean / np.sum(chroma_mean)
+            # Mean-center and normalize so dot products are Pearson correlations
+            chroma_mean = chroma_mean - np.mean(chroma_mean)
+            norm = np.linalg.norm(chroma_mean)
+            if norm == 0:
+                return 'C'  # Flat chroma correlates with no key profile
+            chroma_mean = chroma_mean / norm
             
-            # Calculate correlation with key profiles
-            key_names = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
-            max_corr = -1
-            estimated_key = 'C'
-            
-            for i in range(12):
-                # Rotate profiles to match each key
-                major_rotated = np.roll(major_profile, i)
-                minor_rotated = np.roll(minor_profile, i)
-                
-                # Calculate correlations
-                major_corr = np.corrcoef(chroma_mean, major_rotated)[0, 1]
-                minor_corr = np.corrcoef(chroma_mean, minor_rotated)[0, 1]
-                
-                if major_corr > max_corr:
-                    max_corr = major_corr
-                    estimated_key = f"{key_names[i]} major"
-                
-                if minor_corr > max_corr:
-                    max_corr = minor_corr
-                    estimated_key = f"{key_names[i]} minor"
-            
-            return estimated_key
+            # Correlate with all 24 key profiles at once
+            correlations = KEY_PROFILES @ chroma_mean
+            return KEY_LABELS[int(np.argmax(correlations))]
             
         except:
             return "Unknown"
@@ -191,35 +296,179 @@ class AudioFingerprinter:
     
     def create_feature_vector(self, fingerprint):
         """Create a flat feature vector from fingerprint"""
-        features = []
-        
-        # Add all scalar features
-        scalar_features = [
-            'spectral_centroids', 'spectral_centroids_std',
-            'spectral_rolloff', 'spectral_rolloff_std',
-            'zero_crossing_rate', 'zero_crossing_rate_std',
-            'spectral_bandwidth', 'spectral_bandwidth_std',
-            'tempo', 'onset_strength', 'onset_strength_std',
-            'harmonic_energy', 'percussive_energy', 'harmonic_percussive_ratio',
-            'rms_energy', 'rms_energy_std', 'dynamic_range',
-            'mel_spectral_mean', 'mel_spectral_std', 'energy'
-        ]
-        
-        for feature in scalar_features:
-            features.append(fingerprint.get(feature, 0.0))
-        
-        # Add array features
-        array_features = ['mfcc', 'mfcc_std', 'chroma', 'chroma_std', 
-                         'spectral_contrast', 'spectral_contrast_std', 
-                         'tonnetz', 'tonnetz_std']
-        
-        for feature in array_features:
-            arr = fingerprint.get(feature, [])
-            if isinstance(arr, np.ndarray):
-                features.extend(arr.tolist())
-            elif isinstance(arr, list):
-                features.extend(arr)
-            else:
-                features.append(0.0)
-        
-        return np.array(features)
\ No newline at end of file
+        # Missing features stay zero so every vector has the same layout
+        features = np.zeros(self.feature_dim, dtype=np.float32)
+        
+        for feature, offset, size in self.feature_layout:
+            value = fingerprint.get(feature)
+            if value is not None:
+                features[offset:offset + size] = value
+        
+        return features
+
+
+class AudioFingerprinterGPU(AudioFingerprinter):
+    """Audio fingerprinting with the spectral features batched on a CUDA GPU"""
+    
+    def __init__(self, sr=22050, hop_length=512, n_mfcc=13, n_fft=2048, n_mels=128):
+        super().__init__(sr=sr, hop_length=hop_length, n_mfcc=n_mfcc, n_fft=n_fft)
+        self.n_mels = n_mels
+        self.device = 'cuda' if self.is_available() else None
+        
+        if self.device:
+            self._build_transforms()
+    
+    @staticmethod
+    def is_available():
+        """Check whether torchaudio and a CUDA device are usable"""
+        return torch is not None and torchaudio is not None and torch.cuda.is_available()
+    
+    def _build_transforms(self):
+        """Build the GPU transforms and filterbanks once"""
+        # Magnitude spectrogram with librosa's default framing
+        self.spectrogram = torchaudio.transforms.Spectrogram(
+            n_fft=self.n_fft,
+            hop_length=self.hop_length,
+            power=1.0,
+            pad_mode='constant'
+        ).to(self.device)
+        
+        # Slaney mel filterbank, matching librosa.feature.melspectrogram
+        self.mel_scale = torchaudio.transforms.MelScale(
+            n_mels=self.n_mels,
+            sample_rate=self.sr,
+            n_stft=self.n_fft // 2 + 1,
+            norm='slaney',
+            mel_scale='slaney'
+        ).to(self.device)
+        
+        self.dct = torchaudio.functional.create_dct(self.n_mfcc, self.n_mels, norm='ortho').to(self.device)
+        self.freqs = torch.from_numpy(librosa.fft_frequencies(sr=self.sr, n_fft=self.n_fft)).float().to(self.device)
+    
+    def extract_fingerprint(self, file_path):
+        """Extract comprehensive audio fingerprint"""
+        return self.extract_fingerprint_batch([file_path])[0]
+    
+    def extract_fingerprint_batch(self, file_paths):
+        """Extract fingerprints for several audio files in one GPU pass"""
+        if self.device is None:
+            return super().extract_fingerprint_batch(file_paths)
+        
+        fingerprints = [None] * len(file_paths)
+        signals = {}
+        
+        for i, file_path in enumerate(file_paths):
+            try:
+                # Signals are held for the whole batch, so no shared buffer
+                signals[i] = self._load_audio(file_path, reuse_buffer=False)
+            except Exception as e:
+                print(f"Error extracting fingerprint from {file_path}: {str(e)}")
+                fingerprints[i] = self._get_empty_fingerprint()
+        
+        order = list(signals)
+        if order:
+            try:
+                spectral_features, spectrograms = self._extract_spectral_features_batch([signals[i] for i in order])
+            except Exception as e:
+                print(f"GPU feature extraction failed, falling back to CPU: {str(e)}")
+                spectrograms = [self._compute_spectrograms(signals[i], self.sr) for i in order]
+                spectral_features = [self._extract_spectral_features(S, mel_spec, chroma, self.sr)
+                                     for S, mel_spec, chroma in spectrograms]
+            
+            # Rhythm, HPSS and tonal features have no torchaudio equivalent
+            for i, fingerprint, (S, mel_spec, chroma) in zip(order, spectral_features, spectrograms):
+                try:
+                    fingerprint.update(self._extract_signal_features(signals[i], S, mel_spec, chroma, self.sr))
+                    fingerprints[i] = fingerprint
+                except Exception as e:
+                    print(f"Error extracting fingerprint from {file_paths[i]}: {str(e)}")
+                    fingerprints[i] = self._get_empty_fingerprint()
+        
+        return fingerprints
+    
+    def _extract_spectral_features_batch(self, signals):
+        """Extract the spectral features and per-signal spectrograms for a batch on the GPU"""
+        lengths = [len(y) for y in signals]
+        
+        # Right-pad to the longest signal and stack to (B, T)
+        batch = torch.zeros((len(signals), max(lengths)), dtype=torch.float32)
+        for i, y in enumerate(signals):
+            batch[i, :len(y)] = torch.from_numpy(y)
+        batch = batch.to(self.device)
+        
+        with torch.no_grad():
+            S = self.spectrogram(batch)  # (B, F, T) magnitude
+            S_power = S ** 2
+            
+            # Frames belonging to each signal, excluding the padding
+            n_frames = torch.tensor([1 + n // self.hop_length for n in lengths], device=self.device)
+            valid = torch.arange(S.shape[-1], device=self.device)[None, :] < n_frames[:, None]
+            
+            # Mel spectrogram and MFCC
+            mel_spec = self.mel_scale(S_power)
+            mel_spec_db = self._power_to_db(mel_spec, valid)
+            mfcc = torch.einsum('bmt,mk->bkt', mel_spec_db, self.dct)
+            
+            # Spectral centroid, bandwidth and 85% rolloff
+            S_norm = S / S.sum(dim=1, keepdim=True).clamp_min(1e-10)
+            freqs = self.freqs[None, :, None]
+            centroid = (S_norm * freqs).sum(dim=1)
+            bandwidth = (S_norm * (freqs - centroid[:, None, :]) ** 2).sum(dim=1).sqrt()
+            cumulative = S.cumsum(dim=1)
+            rolloff_bins = (cumulative < 0.85 * cumulative[:, -1:, :]).sum(dim=1)
+            rolloff = self.freqs[rolloff_bins.clamp_max(len(self.freqs) - 1)]
+            
+            # Mel statistics are relative to each signal's peak, like ref=np.max
+            mel_peak = mel_spec_db.masked_fill(~valid[:, None, :], float('-inf')).amax(dim=(1, 2), keepdim=True)
+            mel_mean, mel_std = self._masked_stats((mel_spec_db - mel_peak).flatten(1, 2), valid.repeat(1, self.n_mels))
+            
+            stats = {
+                'mfcc': self._masked_stats(mfcc, valid),
+                'spectral_centroids': self._masked_stats(centroid, valid),
+                'spectral_rolloff': self._masked_stats(rolloff, valid),
+                'spectral_bandwidth': self._masked_stats(bandwidth, valid),
+            }
+            stats = {name: (mean.cpu().numpy(), std.cpu().numpy()) for name, (mean, std) in stats.items()}
+            mel_mean = mel_mean.cpu().numpy()
+            mel_std = mel_std.cpu().numpy()
+            
+            spectrograms = [(S[i, :, :n].cpu().numpy(), mel_spec[i, :, :n].cpu().numpy())
+                            for i, n in enumerate(n_frames.tolist())]
+        
+        # Chroma is built on the host with each file's tuning estimate, exactly as on the CPU
+        spectrograms = [(S_host, mel_host, librosa.feature.chroma_stft(S=S_host ** 2, sr=self.sr))
+                        for S_host, mel_host in spectrograms]
+        
+        fingerprints = []
+        for i, (_, _, chroma) in enumerate(spectrograms):
+            fingerprint = {}
+            for name, (mean, std) in stats.items():
+                if mean.ndim > 1:
+                    fingerprint[name] = mean[i].astype(np.float64)
+                    fingerprint[f'{name}_std'] = std[i].astype(np.float64)
+                else:
+                    fingerprint[name] = float(mean[i])
+                    fingerprint[f'{name}_std'] = float(std[i])
+            fingerprint['chroma'] = np.mean(chroma, axis=1)
+            fingerprint['chroma_std'] = np.std(chroma, axis=1)
+            fingerprint['mel_spectral_mean'] = float(mel_mean[i])
+            fingerprint['mel_spectral_std'] = float(mel_std[i])
+            fingerprints.append(fingerprint)
+        
+        return fingerprints, spectrograms
+    
+    @staticmethod
+    def _power_to_db(S, valid, top_db=80.0):
+        """Convert a batched power spectrogram to dB, clipped per signal"""
+        S_db = 10.0 * torch.log10(S.clamp_min(1e-10))
+        peak = S_db.masked_fill(~valid[:, None, :], float('-inf')).amax(dim=(1, 2), keepdim=True)
+        return torch.maximum(S_db, peak - top_db)
+    
+    @staticmethod
+    def _masked_stats(x, valid):
+        """Mean and standard deviation over the valid frames of the last axis"""
+        mask = valid.view(valid.shape[0], *([1] * (x.dim() - 2)), valid.shape[-1]).float()
+        count = mask.sum(dim=-1)
+        mean = (x * mask).sum(dim=-1) / count
+        var = (((x - mean.unsqueeze(-1)) ** 2) * mask).sum(dim=-1) / count
+        return mean, var.sqrt()
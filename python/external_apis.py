@@ -1,12 +1,42 @@
 import requests
+import numpy as np
 import os
 import base64
 import hashlib
+import hmac
 import time
+import io
 from typing import List, Dict
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
-import json
+import librosa
+import orjson
+import soundfile as sf
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Threads shared by all external API requests
+EXTERNAL_API_WORKERS = 4
+
+# Spotify accepts up to 100 track ids per audio features request
+SPOTIFY_AUDIO_FEATURES_BATCH = 100
+
+# Spotify audio features kept in memory, least recently used evicted first
+AUDIO_FEATURES_CACHE_SIZE = 4096
+
+# Spotify track info cached in memory, and in songdna.db for 30 days
+SPOTIFY_TRACK_CACHE_SIZE = 4096
+SPOTIFY_CACHE_TTL = 30 * 24 * 60 * 60  # seconds
+
+# Spotify audio features compared on their shared 0-1 scale
+SPOTIFY_SIMILARITY_FEATURES = ('acousticness', 'danceability', 'energy', 'instrumentalness',
+                               'liveness', 'speechiness', 'valence')
+
+# Spotify recommendation results kept per quantized tempo/energy/key, least recently used evicted first
+RECOMMENDATION_CACHE_SIZE = 256
+
+# Seconds of audio from the start of the file sent to ACRCloud for identification
+ACRCLOUD_SAMPLE_SECONDS = 15
 
 class ExternalAPIManager:
     """Manager for external music APIs (Spotify, ACRCloud, etc.)"""
@@ -14,6 +44,15 @@ class ExternalAPIManager:
     def __init__(self):
         self.spotify = None
         self.acrcloud_config = None
+        self.acrcloud_hmac = None  # HMAC-SHA1 keyed with the access secret, copied per request
+        self.executor = ThreadPoolExecutor(max_workers=EXTERNAL_API_WORKERS)
+        self.audio_features_cache = OrderedDict()  # track id -> Spotify audio features
+        self.audio_features_lock = threading.Lock()
+        self.recommendation_cache = OrderedDict()  # (tempo, energy, key, limit) -> formatted Spotify results
+        self.recommendation_lock = threading.Lock()
+        self.track_info_cache = OrderedDict()  # track id -> (fetched_at, Spotify track info)
+        self.track_info_lock = threading.Lock()
+        self.db_local = threading.local()
         self.setup_apis()
     
     def setup_apis(self):
@@ -24,6 +63,10 @@ class ExternalAPIManager:
             client_secret = os.getenv('SPOTIFY_CLIENT_SECRET')
             
             if client_id and client_secret:
+                # spotipy is only needed once credentials are configured
+                import spotipy
+                from spotipy.oauth2 import SpotifyClientCredentials
+                
                 client_credentials_manager = SpotifyClientCredentials(
                     client_id=client_id,
                     client_secret=client_secret
@@ -44,6 +87,7 @@ class ExternalAPIManager:
                     'access_secret': access_secret,
                     'timeout': 10
                 }
+                self.acrcloud_hmac = hmac.new(access_secret.encode(), digestmod=hashlib.sha1)
                 print("ACRCloud API initialized")
             else:
                 print("ACRCloud API credentials not found")
@@ -51,18 +95,30 @@ class ExternalAPIManager:
         except Exception as e:
             print(f"Error setting up APIs: {str(e)}")
     
-    def search_external(self, fingerprint_data, max_results=10):
-        """Search external APIs for similar songs"""
+    def search_external(self, fingerprint_data, max_results=10, on_results=None, source_file=None):
+        """Search external APIs concurrently, passing each API's results to on_results as they arrive"""
         results = []
         
         # Search Spotify
-        spotify_results = self.search_spotify_by_features(fingerprint_data, max_results)
-        results.extend(spotify_results)
+        searches = [self.executor.submit(self.search_spotify_by_features, fingerprint_data, max_results)]
+        
+        # Identify the query audio itself with ACRCloud
+        if source_file and self.acrcloud_config:
+            searches.append(self.executor.submit(self.search_acrcloud, source_file))
         
-        # Add other API searches here
-        # acrcloud_results = self.search_acrcloud(fingerprint_data)
-        # results.extend(acrcloud_results)
+        for future in as_completed(searches):
+            try:
+                api_results = future.result()
+            except Exception as e:
+                print(f"Error in external search: {str(e)}")
+                continue
+            
+            if api_results and on_results:
+                on_results(api_results)
+            results.extend(api_results)
         
+        # Rank across APIs so the slice does not depend on which one finished first
+        results.sort(key=lambda x: x['similarity'], reverse=True)
         return results[:max_results]
     
     def search_spotify_by_features(self, fingerprint_data, max_results=10):
@@ -71,6 +127,13 @@ class ExternalAPIManager:
             return []
         
         try:
+            # Near-duplicate queries reuse the results of an earlier Spotify call
+            cache_key = self._recommendation_key(fingerprint_data, max_results)
+            with self.recommendation_lock:
+                if cache_key in self.recommendation_cache:
+                    self.recommendation_cache.move_to_end(cache_key)
+                    return list(self.recommendation_cache[cache_key])
+            
             # Convert our fingerprint to Spotify-compatible features
             spotify_features = self._convert_to_spotify_features(fingerprint_data)
             
@@ -88,13 +151,18 @@ class ExternalAPIManager:
                 target_valence=spotify_features.get('valence', 0.5)
             )
             
+            # Get audio features for similarity calculation in one request
+            tracks = results['tracks']
+            track_features = self.get_audio_features([track['id'] for track in tracks])
+            
+            query_vector = self._spotify_feature_vector(spotify_features)
+            
             formatted_results = []
-            for track in results['tracks']:
-                # Get audio features for similarity calculation
-                audio_features = self.spotify.audio_features(track['id'])[0]
+            for track in tracks:
+                audio_features = track_features.get(track['id'])
                 
                 if audio_features:
-                    similarity = self._calculate_spotify_similarity(spotify_features, audio_features)
+                    similarity = self._calculate_spotify_similarity(spotify_features, audio_features, query_vector)
                     
                     result = {
                         'title': track['name'],
@@ -112,12 +180,54 @@ class ExternalAPIManager:
             
             # Sort by similarity
             formatted_results.sort(key=lambda x: x['similarity'], reverse=True)
-            return formatted_results
+            
+            with self.recommendation_lock:
+                self.recommendation_cache[cache_key] = formatted_results
+                while len(self.recommendation_cache) > RECOMMENDATION_CACHE_SIZE:
+                    self.recommendation_cache.popitem(last=False)
+            
+            return list(formatted_results)
             
         except Exception as e:
             print(f"Error searching Spotify: {str(e)}")
             return []
     
+    @staticmethod
+    def _recommendation_key(fingerprint_data, max_results):
+        """Quantize the features that drive a recommendation request: tempo to 2 BPM, energy to 0.05"""
+        tempo = fingerprint_data.get('tempo', 120)
+        energy = fingerprint_data.get('energy', 0.5)
+        key_str = fingerprint_data.get('key')
+        return (round(tempo / 2) * 2, round(energy * 20) / 20, key_str, max_results)
+    
+    def get_audio_features(self, track_ids):
+        """Get Spotify audio features for several tracks, batching the ids not already cached"""
+        features = {}
+        missing = []
+        
+        with self.audio_features_lock:
+            for track_id in track_ids:
+                if track_id in self.audio_features_cache:
+                    self.audio_features_cache.move_to_end(track_id)
+                    features[track_id] = self.audio_features_cache[track_id]
+                elif track_id not in missing:
+                    missing.append(track_id)
+        
+        for start in range(0, len(missing), SPOTIFY_AUDIO_FEATURES_BATCH):
+            batch = missing[start:start + SPOTIFY_AUDIO_FEATURES_BATCH]
+            batch_features = self.spotify.audio_features(batch) or []
+            
+            with self.audio_features_lock:
+                for track_id, audio_features in zip(batch, batch_features):
+                    features[track_id] = audio_features
+                    if audio_features:
+                        self.audio_features_cache[track_id] = audio_features
+                
+                while len(self.audio_features_cache) > AUDIO_FEATURES_CACHE_SIZE:
+                    self.audio_features_cache.popitem(last=False)
+        
+        return features
+    
     def _convert_to_spotify_features(self, fingerprint_data):
         """Convert our fingerprint to Spotify-compatible features"""
         try:
@@ -162,27 +272,23 @@ class ExternalAPIManager:
                 'valence': 0.5
             }
     
-    def _calculate_spotify_similarity(self, query_features, track_features):
+    def _spotify_feature_vector(self, features):
+        """Spotify audio features in SPOTIFY_SIMILARITY_FEATURES order, NaN where missing"""
+        values = (features.get(feature) for feature in SPOTIFY_SIMILARITY_FEATURES)
+        return np.fromiter((np.nan if value is None else value for value in values),
+                           dtype=np.float64, count=len(SPOTIFY_SIMILARITY_FEATURES))
+    
+    def _calculate_spotify_similarity(self, query_features, track_features, query_vector=None):
         """Calculate similarity between query and Spotify track features"""
         try:
-            # Features to compare
-            feature_names = ['acousticness', 'danceability', 'energy', 'instrumentalness', 
-                           'liveness', 'speechiness', 'valence']
+            if query_vector is None:
+                query_vector = self._spotify_feature_vector(query_features)
             
-            total_similarity = 0
-            valid_features = 0
-            
-            for feature in feature_names:
-                if feature in query_features and feature in track_features:
-                    query_val = query_features[feature]
-                    track_val = track_features[feature]
-                    
-                    # Calculate normalized difference (0 = identical, 1 = maximum difference)
-                    diff = abs(query_val - track_val)
-                    similarity = 1 - diff  # Convert to similarity (1 = identical, 0 = maximum difference)
-                    
-                    total_similarity += similarity
-                    valid_features += 1
+            # Normalized differences of the features both sides have (1 = identical, 0 = maximum difference)
+            similarities = 1 - np.abs(query_vector - self._spotify_feature_vector(track_features))
+            valid = ~np.isnan(similarities)
+            total_similarity = float(similarities[valid].sum())
+            valid_features = int(valid.sum())
             
             # Tempo similarity (special handling due to different scale)
             if 'tempo' in query_features and 'tempo' in track_features:
@@ -211,26 +317,19 @@ class ExternalAPIManager:
             return []
         
         try:
-            # Read audio file
-            with open(audio_file_path, 'rb') as f:
-                audio_data = f.read()
+            sample = self._load_acrcloud_sample(audio_file_path)
             
             # Prepare ACRCloud request
             timestamp = str(int(time.time()))
             string_to_sign = f"POST\n/v1/identify\n{self.acrcloud_config['access_key']}\naudio\n1\n{timestamp}"
-            signature = base64.b64encode(
-                hashlib.hmac.new(
-                    self.acrcloud_config['access_secret'].encode(),
-                    string_to_sign.encode(),
-                    hashlib.sha1
-                ).digest()
-            ).decode()
+            signer = self.acrcloud_hmac.copy()
+            signer.update(string_to_sign.encode())
+            signature = base64.b64encode(signer.digest()).decode()
             
             # Request data
-            files = {'sample': audio_data}
             data = {
                 'access_key': self.acrcloud_config['access_key'],
-                'sample_bytes': len(audio_data),
+                'sample_bytes': len(sample),
                 'timestamp': timestamp,
                 'signature': signature,
                 'data_type': 'audio',
@@ -238,6 +337,7 @@ class ExternalAPIManager:
             }
             
             # Make request
+            files = {'sample': (os.path.splitext(os.path.basename(audio_file_path))[0] + '.wav', sample, 'audio/wav')}
             response = requests.post(
                 f"http://{self.acrcloud_config['host']}/v1/identify",
                 files=files,
@@ -256,6 +356,22 @@ class ExternalAPIManager:
             print(f"Error searching ACRCloud: {str(e)}")
             return []
     
+    def _load_acrcloud_sample(self, audio_file_path):
+        """Encode the start of an audio file as a mono 16-bit WAV clip for identification"""
+        try:
+            with sf.SoundFile(audio_file_path) as audio:
+                sr = audio.samplerate
+                clip = audio.read(int(sr * ACRCLOUD_SAMPLE_SECONDS), dtype='float32')
+            if clip.ndim > 1:
+                clip = clip.mean(axis=1)  # Downmix to mono
+        except RuntimeError:
+            # Formats libsndfile cannot decode (e.g. m4a/aac) go through audioread
+            clip, sr = librosa.load(audio_file_path, sr=None, duration=ACRCLOUD_SAMPLE_SECONDS)
+        
+        buffer = io.BytesIO()
+        sf.write(buffer, clip, sr, format='WAV', subtype='PCM_16')
+        return buffer.getvalue()
+    
     def _parse_acrcloud_results(self, acrcloud_result):
         """Parse ACRCloud API results"""
         try:
@@ -290,14 +406,64 @@ class ExternalAPIManager:
             return None
         
         try:
-            track = self.spotify.track(track_id)
-            audio_features = self.spotify.audio_features(track_id)[0]
-            
-            return {
-                'track': track,
-                'audio_features': audio_features
-            }
+            return self._fetch_spotify_track_info(track_id)
             
         except Exception as e:
             print(f"Error getting Spotify track info: {str(e)}")
-            return None
\ No newline at end of file
+            return None
+    
+    def _fetch_spotify_track_info(self, track_id):
+        """Fetch track information from the memory or disk cache, or from Spotify when missing or stale"""
+        now = int(time.time())
+        with self.track_info_lock:
+            cached = self.track_info_cache.get(track_id)
+            if cached and cached[0] >= now - SPOTIFY_CACHE_TTL:
+                self.track_info_cache.move_to_end(track_id)
+                return cached[1]
+        
+        cached = self._load_cached_track_info(track_id)
+        if cached is None:
+            info = {
+                'track': self.spotify.track(track_id),
+                'audio_features': self.get_audio_features([track_id]).get(track_id)
+            }
+            cached = (now, info)
+            self._store_cached_track_info(track_id, info, now)
+        
+        with self.track_info_lock:
+            self.track_info_cache[track_id] = cached
+            self.track_info_cache.move_to_end(track_id)
+            while len(self.track_info_cache) > SPOTIFY_TRACK_CACHE_SIZE:
+                self.track_info_cache.popitem(last=False)
+        
+        return cached[1]
+    
+    def _get_db(self):
+        """Return this thread's cache database connection"""
+        conn = getattr(self.db_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect('songdna.db', check_same_thread=False, isolation_level=None)
+            self.db_local.conn = conn
+        return conn
+    
+    def _load_cached_track_info(self, track_id):
+        """Load fresh track information and its fetch time from the spotify_cache table"""
+        try:
+            row = self._get_db().execute(
+                'SELECT fetched_at, payload FROM spotify_cache WHERE track_id = ? AND fetched_at >= ?',
+                (track_id, int(time.time()) - SPOTIFY_CACHE_TTL)
+            ).fetchone()
+            return (row[0], orjson.loads(row[1])) if row else None
+        except Exception as e:
+            print(f"Error reading Spotify cache: {str(e)}")
+            return None
+    
+    def _store_cached_track_info(self, track_id, info, fetched_at):
+        """Save track information to the spotify_cache table"""
+        try:
+            self._get_db().execute(
+                'INSERT OR REPLACE INTO spotify_cache (track_id, payload, fetched_at) VALUES (?, ?, ?)',
+                (track_id, orjson.dumps(info), fetched_at)
+            )
+        except Exception as e:
+            print(f"Error writing Spotify cache: {str(e)}")
@@ -1,38 +1,129 @@
 import numpy as np
 import sqlite3
-import json
-from scipy.spatial.distance import cosine, euclidean
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.preprocessing import StandardScaler
-import faiss
+import os
+import hashlib
+import threading
+from collections import namedtuple
 from audio_fingerprint import AudioFingerprinter
 
+# Libraries at least this large are searched through an HNSW graph
+HNSW_MIN_SONGS = 10000
+HNSW_NEIGHBORS = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Very large libraries switch to an inverted file of product-quantized codes
+IVFPQ_MIN_SONGS = 1000000
+IVFPQ_BITS = 8
+IVFPQ_NPROBE = 16
+
+# Approximate candidates fetched per requested result, rescored against the exact features
+ANN_RERANK_FACTOR = 4
+
+# SimHash prefilter for large libraries without an HNSW index
+SIMHASH_BITS = 64
+SIMHASH_CANDIDATES = 1000
+
+# Set bits per byte value, for Hamming distances without np.bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Persisted approximate index, labelled with songs.id
+INDEX_PATH = 'songdna.faiss'
+INDEX_SAVE_INTERVAL = 100
+
+# Scaler statistics the persisted index was built with, and a checksum of the songs it holds
+INDEX_STATS_PATH = 'songdna.faiss.npz'
+
+# Paths looked up per query when reading back newly stored songs
+SONG_LOOKUP_BATCH = 500
+
+# Unit MFCC and chroma rows are stored as int8 multiples of 1/127
+DETAIL_QUANT_SCALE = 127
+
+# Key code of songs whose key is unknown
+UNKNOWN_KEY_CODE = -1
+
+# Weights of the detailed similarity metrics in the overall score
+DETAIL_WEIGHTS = {
+    'mfcc': 0.3,
+    'chroma': 0.25,
+    'tempo': 0.2,
+    'energy': 0.15,
+    'key': 0.1
+}
+
+# Arrays of one build of the search index. Searches read the whole set once and updates
+# replace it in a single assignment, so a search never pairs arrays from different builds.
+IndexState = namedtuple('IndexState', [
+    'meta',  # (id, file_path, title, artist, album, key) per row
+    'features',  # (N, D) float32, rows unit L2-normalized
+    'feature_mean',  # (D,) float32 per-dimension mean of the library
+    'feature_inv_std',  # (D,) float32 reciprocal of the per-dimension standard deviation
+    'index',  # FAISS HNSW or IVF-PQ index for large libraries
+    'id_to_row',  # songs.id -> row
+    'simhash_planes',  # (D, 64) random hyperplanes
+    'simhash_codes',  # (N,) uint64 sign bits of each row
+    'mfcc_mat',  # (N, n_mfcc) int8, unit rows scaled by DETAIL_QUANT_SCALE
+    'chroma_mat',  # (N, 12) int8, unit rows scaled by DETAIL_QUANT_SCALE
+    'tempo_arr',  # (N,) float32
+    'energy_arr',  # (N,) float32
+    'keys_arr',  # (N,) int32 key codes, UNKNOWN_KEY_CODE when unknown
+])
+
+# Per-row arrays grown by incremental additions, besides the feature matrix
+DETAIL_ARRAYS = ('mfcc_mat', 'chroma_mat', 'tempo_arr', 'energy_arr', 'keys_arr')
+
 class SimilarityEngine:
     """Advanced similarity search engine for audio fingerprints"""
     
     def __init__(self):
         self.fingerprinter = AudioFingerprinter()
-        self.scaler = StandardScaler()
-        self.index = None
+        self.conn = self._connect()
+        self.state = self._empty_state()
         self.feature_dim = None
-        self.indexed_songs = []
+        self.unsaved_additions = 0
+        self.content_hashes = None  # sha256 of the indexed ids and of their feature vectors, in row order
+        self.key_codes = {}  # key name -> code
+        self.row_buffers = {}  # array name -> spare-capacity buffer it is a view of
+        self.update_lock = threading.RLock()  # serializes index updates from handler threads
+        self.faiss_lock = threading.Lock()  # FAISS indexes cannot be searched while rows are added
         self._initialize_index()
     
     def _initialize_index(self):
-        """Initialize FAISS index for fast similarity search"""
+        """Initialize the feature matrix for fast similarity search"""
         try:
             # Load existing songs and build index
             songs = self._load_all_songs()
             if songs:
                 self._build_faiss_index(songs)
+            
+            # Songs stored before packed feature vectors are left out of the index until migrated
+            legacy_songs = self._count_legacy_songs()
+            if legacy_songs:
+                print(f"{legacy_songs} songs have only legacy JSON fingerprints and are not searchable; "
+                      "run `python app.py --migrate-fingerprints` (npm run migrate-fingerprints) to re-fingerprint them")
         except Exception as e:
             print(f"Error initializing index: {str(e)}")
     
+    @staticmethod
+    def _empty_state():
+        """Index state of a library with no indexed songs"""
+        return IndexState(*[None] * len(IndexState._fields))._replace(meta=[], id_to_row={})
+    
+    @staticmethod
+    def _connect():
+        """Open the engine's read connection to the songs database"""
+        conn = sqlite3.connect('songdna.db', check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')  # 256 MB
+        conn.row_factory = sqlite3.Row
+        return conn
+    
     def _load_all_songs(self):
         """Load all songs from database"""
         try:
-            conn = sqlite3.connect('songdna.db')
-            cursor = conn.cursor()
+            cursor = self.conn.cursor()
             
             # Check if table exists first
             cursor.execute("""
@@ -41,135 +132,338 @@ class SimilarityEngine:
             """)
             
             if not cursor.fetchone():
-                conn.close()
                 return []  # Table doesn't exist yet
                 
             cursor.execute('''
-                SELECT id, file_path, title, artist, album, fingerprint_data, tempo, key_signature, energy
+                SELECT id, file_path, title, artist, album, feature_vec, tempo, key_signature, energy
                 FROM songs 
-                WHERE fingerprint_data IS NOT NULL
+                WHERE feature_vec IS NOT NULL
+                ORDER BY id
             ''')
-            songs = cursor.fetchall()
-            conn.close()
-            return songs
+            return cursor.fetchall()
         except Exception as e:
             print(f"Error loading songs: {str(e)}")
             return []
     
+    def _load_songs_by_path(self, file_paths):
+        """Load the stored songs at the given paths"""
+        songs = []
+        for start in range(0, len(file_paths), SONG_LOOKUP_BATCH):
+            batch = file_paths[start:start + SONG_LOOKUP_BATCH]
+            cursor = self.conn.execute(f'''
+                SELECT id, file_path, title, artist, album, feature_vec, tempo, key_signature, energy
+                FROM songs 
+                WHERE feature_vec IS NOT NULL AND file_path IN ({', '.join('?' * len(batch))})
+            ''', batch)
+            songs.extend(cursor.fetchall())
+        return songs
+    
+    def _count_indexable_songs(self):
+        """Count the stored songs whose feature vectors fit the current layout"""
+        vector_bytes = self.fingerprinter.feature_dim * np.dtype(np.float32).itemsize
+        cursor = self.conn.execute('SELECT COUNT(*) FROM songs WHERE length(feature_vec) = ?', (vector_bytes,))
+        return cursor.fetchone()[0]
+    
+    def _count_legacy_songs(self):
+        """Count the stored songs that only have a legacy JSON fingerprint"""
+        cursor = self.conn.execute('SELECT COUNT(*) FROM songs WHERE feature_vec IS NULL AND fingerprint_data IS NOT NULL')
+        return cursor.fetchone()[0]
+    
     def _build_faiss_index(self, songs):
-        """Build FAISS index for fast similarity search"""
+        """Build the normalized feature matrix for fast similarity search"""
         try:
-            features = []
-            self.indexed_songs = []
-            
+            # Skip vectors packed for a different feature layout
+            vector_bytes = self.fingerprinter.feature_dim * np.dtype(np.float32).itemsize
+            valid_songs = []
             for song in songs:
-                try:
-                    # Parse fingerprint data
-                    fingerprint_data = json.loads(song[5])  # fingerprint_data column
-                    
-                    # Convert back to proper format
-                    fingerprint = self._parse_fingerprint(fingerprint_data)
-                    
-                    # Create feature vector
-                    feature_vector = self.fingerprinter.create_feature_vector(fingerprint)
-                    features.append(feature_vector)
-                    
-                    # Store song info
-                    self.indexed_songs.append({
-                        'id': song[0],
-                        'file_path': song[1],
-                        'title': song[2],
-                        'artist': song[3],
-                        'album': song[4],
-                        'tempo': song[6],
-                        'key': song[7],
-                        'energy': song[8],
-                        'fingerprint': fingerprint
-                    })
-                    
-                except Exception as e:
-                    print(f"Error processing song {song[1]}: {str(e)}")
-                    continue
-            
-            if features:
-                features = np.array(features).astype('float32')
-                
-                # Normalize features
-                features = self.scaler.fit_transform(features)
-                
-                # Build FAISS index
-                self.feature_dim = features.shape[1]
-                self.index = faiss.IndexFlatIP(self.feature_dim)  # Inner product (cosine similarity)
-                
-                # Normalize for cosine similarity
-                faiss.normalize_L2(features)
-                self.index.add(features)
-                
-                print(f"Built FAISS index with {len(features)} songs, {self.feature_dim} dimensions")
+                if song['feature_vec'] is not None and len(song['feature_vec']) == vector_bytes:
+                    valid_songs.append(song)
+                else:
+                    print(f"Error processing song {song['file_path']}: unexpected feature vector size")
+            
+            # Store song info
+            meta = [(song['id'], song['file_path'], song['title'], song['artist'],
+                     song['album'], song['key_signature']) for song in valid_songs]
+            
+            if not meta:
+                self.state = self._empty_state()
+                return
+            
+            # Decode every packed float32 feature vector in one pass
+            ids = np.array([song[0] for song in meta], dtype=np.int64)
+            packed = b''.join(song['feature_vec'] for song in valid_songs)
+            content_hashes = (hashlib.sha256(ids.tobytes()), hashlib.sha256(packed))
+            features = np.frombuffer(packed, dtype=np.float32)
+            features = features.reshape(len(meta), self.fingerprinter.feature_dim)
+            
+            # Per-metric arrays for detailed similarity
+            keys = [song[5] for song in meta]
+            mfcc_mat, chroma_mat, tempo_arr, energy_arr, keys_arr = self._build_detail_arrays(features, keys)
+            
+            # A persisted index holding exactly these songs was scaled with its own statistics
+            stored_stats = None
+            if len(meta) >= HNSW_MIN_SONGS:
+                stored_stats = self._load_index_stats(self._checksum(content_hashes))
+            
+            if stored_stats is not None:
+                feature_mean, feature_inv_std = stored_stats
+            else:
+                # Standardize each dimension; constant dimensions are only centered
+                std = features.std(axis=0, dtype=np.float64)
+                std[std == 0] = 1.0
+                feature_mean = features.mean(axis=0, dtype=np.float64).astype(np.float32)
+                feature_inv_std = (1.0 / std).astype(np.float32)
+            
+            # Unit rows turn cosine similarity into a single matrix-vector product
+            features = self._normalize_rows((features - feature_mean) * feature_inv_std)
+            feature_dim = features.shape[1]
+            
+            # Fixed random hyperplanes so codes are reproducible across rebuilds
+            rng = np.random.default_rng(0)
+            simhash_planes = rng.standard_normal((feature_dim, SIMHASH_BITS)).astype(np.float32)
+            simhash_codes = self._simhash(features, simhash_planes)
+            
+            id_to_row = {int(song_id): row for row, song_id in enumerate(ids)}
+            self.content_hashes = content_hashes
+            
+            # Brute force is fast enough for small libraries
+            index = None
+            if len(features) >= HNSW_MIN_SONGS:
+                index = self._load_or_build_ann_index(features, ids, feature_mean, feature_inv_std,
+                                                      reuse=stored_stats is not None)
+            
+            self.feature_dim = feature_dim
+            self.state = IndexState(
+                meta=meta, features=features, feature_mean=feature_mean, feature_inv_std=feature_inv_std,
+                index=index, id_to_row=id_to_row, simhash_planes=simhash_planes, simhash_codes=simhash_codes,
+                mfcc_mat=mfcc_mat, chroma_mat=chroma_mat, tempo_arr=tempo_arr, energy_arr=energy_arr,
+                keys_arr=keys_arr
+            )
+            
+            print(f"Built feature index with {len(features)} songs, {feature_dim} dimensions")
             
         except Exception as e:
-            print(f"Error building FAISS index: {str(e)}")
+            print(f"Error building feature index: {str(e)}")
     
-    def _parse_fingerprint(self, fingerprint_data):
-        """Parse fingerprint data from JSON format"""
-        fingerprint = {}
+    def _load_or_build_ann_index(self, features, ids, feature_mean, feature_inv_std, reuse):
+        """Load the persisted approximate index if it was built from these songs, otherwise build it"""
+        try:
+            import faiss
+        except ImportError:
+            print("FAISS not installed, large libraries use the SimHash prefilter")
+            return None
+        
+        dim = features.shape[1]
+        index_class = faiss.IndexIVFPQ if len(ids) >= IVFPQ_MIN_SONGS else faiss.IndexHNSWSQ
         
-        # Convert lists back to numpy arrays
-        array_features = ['mfcc', 'chroma', 'spectral_centroids', 'spectral_rolloff', 'zero_crossing_rate']
-        for feature in array_features:
-            if feature in fingerprint_data and fingerprint_data[feature]:
-                fingerprint[feature] = np.array(fingerprint_data[feature])
+        if reuse and os.path.exists(INDEX_PATH):
+            try:
+                index = faiss.read_index(INDEX_PATH)
+                stored_ids = faiss.vector_to_array(index.id_map)
+                if (index.d == dim
+                        and isinstance(faiss.downcast_index(index.index), index_class)
+                        and np.array_equal(np.sort(stored_ids), np.sort(ids))):
+                    self._configure_search(index)
+                    return index
+            except Exception as e:
+                print(f"Error loading approximate index: {str(e)}")
+        
+        try:
+            if index_class is faiss.IndexIVFPQ:
+                # sqrt(N) inverted lists of 8-bit codes over 4-dimension subvectors
+                nlist = int(np.sqrt(len(ids)))
+                m = max(m for m in range(1, dim // 4 + 1) if dim % m == 0)
+                quantizer = faiss.IndexFlatIP(dim)
+                inner = faiss.IndexIVFPQ(quantizer, dim, nlist, m, IVFPQ_BITS, faiss.METRIC_INNER_PRODUCT)
+            else:
+                # Graph vectors are stored as 8-bit codes with trained per-dimension ranges
+                inner = faiss.IndexHNSWSQ(
+                    dim, faiss.ScalarQuantizer.QT_8bit, HNSW_NEIGHBORS, faiss.METRIC_INNER_PRODUCT
+                )
+                inner.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            
+            index = faiss.IndexIDMap(inner)
+            index.train(features)
+            index.add_with_ids(features, ids)
+            self._configure_search(index)
+        except Exception as e:
+            print(f"Error building approximate index: {str(e)}")
+            return None
         
-        # Add scalar features
-        scalar_features = ['tempo', 'energy']
-        for feature in scalar_features:
-            fingerprint[feature] = fingerprint_data.get(feature, 0.0)
+        self._save_index(index, feature_mean, feature_inv_std)
+        return index
+    
+    @staticmethod
+    def _configure_search(index):
+        """Set the recall/speed trade-off of an approximate index"""
+        import faiss
+        inner = faiss.downcast_index(index.index)
+        if isinstance(inner, faiss.IndexIVFPQ):
+            inner.nprobe = IVFPQ_NPROBE
+        else:
+            inner.hnsw.efSearch = HNSW_EF_SEARCH
+    
+    def save_index(self):
+        """Persist the approximate index if songs were added since it was last saved"""
+        with self.update_lock:
+            if self.state.index is not None and self.unsaved_additions:
+                self._save_index(self.state.index, self.state.feature_mean, self.state.feature_inv_std)
+    
+    def _save_index(self, index, feature_mean, feature_inv_std):
+        """Persist the approximate index to disk with the statistics its vectors were scaled by"""
+        import faiss
+        try:
+            faiss.write_index(index, INDEX_PATH)
+            np.savez(INDEX_STATS_PATH, feature_mean=feature_mean, feature_inv_std=feature_inv_std,
+                     checksum=np.array(self._checksum(self.content_hashes)))
+            self.unsaved_additions = 0
+        except Exception as e:
+            print(f"Error saving approximate index: {str(e)}")
+    
+    @staticmethod
+    def _checksum(content_hashes):
+        """Checksum of the indexed songs, changed by any added, removed or edited row"""
+        return ''.join(content_hash.hexdigest() for content_hash in content_hashes)
+    
+    @staticmethod
+    def _load_index_stats(checksum):
+        """Load the scaler statistics of the persisted index if it holds the songs with this checksum"""
+        try:
+            if not os.path.exists(INDEX_STATS_PATH):
+                return None
+            with np.load(INDEX_STATS_PATH) as stats:
+                if str(stats['checksum']) != checksum:
+                    return None
+                return stats['feature_mean'], stats['feature_inv_std']
+        except Exception as e:
+            print(f"Error loading approximate index statistics: {str(e)}")
+            return None
+    
+    def _search_candidates(self, state, query_vector, k):
+        """Find the k nearest rows to a normalized query vector"""
+        features = state.features
+        if state.index is not None:
+            # Over-fetch from the approximate index, then rescore the candidates exactly.
+            # Songs added after this search read its state are not rows of its matrix yet.
+            with self.faiss_lock:
+                _, labels = state.index.search(query_vector.reshape(1, -1), k * ANN_RERANK_FACTOR)
+            rows = (state.id_to_row.get(int(label), -1) for label in labels[0] if label != -1)
+            candidates = np.array([row for row in rows if 0 <= row < len(features)], dtype=np.int64)
+            scores = features[candidates] @ query_vector
+        elif len(features) >= HNSW_MIN_SONGS:
+            # No HNSW index: only score the songs nearest in Hamming distance
+            candidates = self._simhash_candidates(state, query_vector, max(k, SIMHASH_CANDIDATES))
+            scores = features[candidates] @ query_vector
+        else:
+            # Score every song at once
+            candidates = np.arange(len(features))
+            scores = features @ query_vector
         
-        fingerprint['key'] = fingerprint_data.get('key', 'Unknown')
+        # Keep the top k
+        k = min(k, len(candidates))
+        if k == 0:
+            return candidates, scores
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return candidates[top], scores[top]
+    
+    @staticmethod
+    def _simhash(features, planes):
+        """Compute 64-bit SimHash codes from the signs of random projections"""
+        bits = (features @ planes) > 0
+        return np.packbits(bits, axis=1).view(np.uint64).ravel()
+    
+    def _simhash_candidates(self, state, query_vector, count):
+        """Find the rows whose SimHash codes are nearest the query's"""
+        query_code = self._simhash(query_vector.reshape(1, -1), state.simhash_planes)
+        distances = POPCOUNT_TABLE[np.bitwise_xor(state.simhash_codes, query_code).view(np.uint8)]
+        distances = distances.reshape(-1, SIMHASH_BITS // 8).sum(axis=1)
         
-        return fingerprint
+        count = min(count, len(distances))
+        return np.argpartition(distances, count - 1)[:count]
+    
+    @staticmethod
+    def _scale(state, feature_vector):
+        """Standardize a feature vector with the statistics of the last rebuild"""
+        return (feature_vector - state.feature_mean) * state.feature_inv_std
+    
+    @staticmethod
+    def _normalize_rows(features):
+        """L2-normalize each row of a feature matrix in place"""
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        features /= np.maximum(norms, 1e-10)
+        return features
+    
+    def _feature_slice(self, feature):
+        """Columns of a packed feature vector holding one feature"""
+        for name, offset, size in self.fingerprinter.feature_layout:
+            if name == feature:
+                return slice(offset, offset + size)
+        raise KeyError(feature)
+    
+    def _build_detail_arrays(self, features, keys):
+        """Split packed feature vectors into the arrays used by detailed similarity"""
+        mfcc = self._quantize_rows(np.array(features[:, self._feature_slice('mfcc')], dtype=np.float32))
+        chroma = self._quantize_rows(np.array(features[:, self._feature_slice('chroma')], dtype=np.float32))
+        tempo = features[:, self._feature_slice('tempo')].ravel().astype(np.float32)
+        energy = features[:, self._feature_slice('energy')].ravel().astype(np.float32)
+        keys = np.array([self._key_code(key) for key in keys], dtype=np.int32)
+        return mfcc, chroma, tempo, energy, keys
+    
+    def _key_code(self, key):
+        """Integer code of a key name, so key matching compares ints"""
+        if not key or key == 'Unknown':
+            return UNKNOWN_KEY_CODE
+        return self.key_codes.setdefault(key, len(self.key_codes))
+    
+    def _quantize_rows(self, features):
+        """L2-normalize each row and round it to int8"""
+        return np.round(self._normalize_rows(features) * DETAIL_QUANT_SCALE).astype(np.int8)
     
     def search_local(self, query_fingerprint, max_results=20, threshold=0.7):
         """Search for similar songs in local database"""
         try:
-            if not self.index or not self.indexed_songs:
+            # Read the index state once so every array comes from the same build
+            state = self.state
+            if state.features is None:
                 return []
             
             # Create feature vector from query
             query_vector = self.fingerprinter.create_feature_vector(query_fingerprint)
-            query_vector = query_vector.reshape(1, -1).astype('float32')
             
             # Normalize query
-            query_vector = self.scaler.transform(query_vector)
-            faiss.normalize_L2(query_vector)
+            query_vector = self._scale(state, query_vector)
+            query_vector /= max(np.linalg.norm(query_vector), 1e-10)
             
             # Search
-            k = min(max_results * 2, len(self.indexed_songs))  # Get more results to filter
-            similarities, indices = self.index.search(query_vector, k)
+            k = min(max_results * 2, len(state.features))  # Get more results to filter
+            indices, similarities = self._search_candidates(state, query_vector, k)
+            
+            # Score the detailed metrics for every candidate above the threshold at once
+            passed = np.flatnonzero(similarities >= threshold)
+            detailed = self._calculate_detailed_similarity(state, query_fingerprint, indices[passed])
             
             results = []
-            for i, (similarity, idx) in enumerate(zip(similarities[0], indices[0])):
-                if similarity >= threshold:
-                    song = self.indexed_songs[idx]
-                    
-                    # Calculate additional similarity metrics
-                    detailed_similarity = self._calculate_detailed_similarity(
-                        query_fingerprint, song['fingerprint']
-                    )
-                    
-                    result = {
-                        'title': song['title'],
-                        'artist': song['artist'],
-                        'album': song['album'],
-                        'file_path': song['file_path'],
-                        'similarity': float(similarity),
-                        'detailed_similarity': detailed_similarity,
-                        'tempo': song['tempo'],
-                        'key': song['key'],
-                        'energy': song['energy'],
-                        'rank': i + 1
-                    }
-                    results.append(result)
+            for j, i in enumerate(passed):
+                similarity = similarities[i]
+                row = indices[i]
+                song_id, file_path, title, artist, album, key = state.meta[row]
+                detailed_similarity = {metric: float(values[j]) for metric, values in detailed.items()}
+                
+                result = {
+                    'title': title,
+                    'artist': artist,
+                    'album': album,
+                    'file_path': file_path,
+                    'similarity': float(similarity),
+                    'detailed_similarity': detailed_similarity,
+                    'tempo': float(state.tempo_arr[row]),
+                    'key': key,
+                    'energy': float(state.energy_arr[row]),
+                    'rank': int(i) + 1,
+                    'source': 'local'
+                }
+                results.append(result)
             
             # Sort by similarity and limit results
             results.sort(key=lambda x: x['similarity'], reverse=True)
@@ -179,99 +473,150 @@ class SimilarityEngine:
             print(f"Error in local search: {str(e)}")
             return []
     
-    def _calculate_detailed_similarity(self, query_fp, target_fp):
-        """Calculate detailed similarity metrics between fingerprints"""
+    def _calculate_detailed_similarity(self, state, query_fp, rows):
+        """Calculate detailed similarity metrics between a query and the songs at the given rows"""
         similarities = {}
         
         try:
-            # MFCC similarity
-            if 'mfcc' in query_fp and 'mfcc' in target_fp:
-                mfcc_sim = 1 - cosine(query_fp['mfcc'], target_fp['mfcc'])
-                similarities['mfcc'] = max(0, mfcc_sim)
-            
-            # Chroma similarity
-            if 'chroma' in query_fp and 'chroma' in target_fp:
-                chroma_sim = 1 - cosine(query_fp['chroma'], target_fp['chroma'])
-                similarities['chroma'] = max(0, chroma_sim)
+            # MFCC and chroma similarity against the quantized unit-row matrices
+            for feature, matrix in (('mfcc', state.mfcc_mat), ('chroma', state.chroma_mat)):
+                if feature in query_fp:
+                    query = np.asarray(query_fp[feature], dtype=np.float32)
+                    query = query / (max(np.linalg.norm(query), 1e-10) * DETAIL_QUANT_SCALE)
+                    similarities[feature] = np.clip(matrix[rows].astype(np.float32) @ query, 0.0, 1.0)
             
             # Tempo similarity
             query_tempo = query_fp.get('tempo', 120)
-            target_tempo = target_fp.get('tempo', 120)
-            tempo_diff = abs(query_tempo - target_tempo) / max(query_tempo, target_tempo, 1)
-            similarities['tempo'] = max(0, 1 - tempo_diff)
+            target_tempo = state.tempo_arr[rows]
+            tempo_diff = np.abs(query_tempo - target_tempo) / np.maximum(np.maximum(query_tempo, target_tempo), 1)
+            similarities['tempo'] = np.maximum(0, 1 - tempo_diff)
             
             # Energy similarity
             query_energy = query_fp.get('energy', 0)
-            target_energy = target_fp.get('energy', 0)
-            if query_energy > 0 and target_energy > 0:
-                energy_ratio = min(query_energy, target_energy) / max(query_energy, target_energy)
-                similarities['energy'] = energy_ratio
+            target_energy = state.energy_arr[rows]
+            if query_energy > 0:
+                energy_ratio = np.minimum(query_energy, target_energy) / np.maximum(query_energy, target_energy)
+                similarities['energy'] = np.where(target_energy > 0, energy_ratio, 0.5)
             else:
-                similarities['energy'] = 0.5
+                similarities['energy'] = np.full(len(rows), 0.5)
             
             # Key similarity (simple matching)
             query_key = query_fp.get('key', 'Unknown')
-            target_key = target_fp.get('key', 'Unknown')
-            if query_key != 'Unknown' and target_key != 'Unknown':
-                similarities['key'] = 1.0 if query_key == target_key else 0.3
+            target_keys = state.keys_arr[rows]
+            if query_key != 'Unknown':
+                # Keys no indexed song has never match
+                query_code = self.key_codes.get(query_key, UNKNOWN_KEY_CODE - 1)
+                similarities['key'] = np.where(target_keys == UNKNOWN_KEY_CODE, 0.5,
+                                               np.where(target_keys == query_code, 1.0, 0.3))
             else:
-                similarities['key'] = 0.5
-            
-            # Overall weighted similarity
-            weights = {
-                'mfcc': 0.3,
-                'chroma': 0.25,
-                'tempo': 0.2,
-                'energy': 0.15,
-                'key': 0.1
-            }
-            
-            weighted_sum = sum(similarities.get(feature, 0) * weight 
-                             for feature, weight in weights.items())
+                similarities['key'] = np.full(len(rows), 0.5)
             
-            similarities['overall'] = weighted_sum
+            # Overall weighted similarity in one product
+            features = [feature for feature in DETAIL_WEIGHTS if feature in similarities]
+            weights = np.array([DETAIL_WEIGHTS[feature] for feature in features])
+            similarities['overall'] = weights @ np.stack([similarities[feature] for feature in features])
             
         except Exception as e:
             print(f"Error calculating detailed similarity: {str(e)}")
-            similarities = {'overall': 0.0}
+            similarities = {'overall': np.zeros(len(rows))}
         
         return similarities
     
+    def add_stored_songs(self, file_paths):
+        """Add the songs just stored at these paths to the search index"""
+        try:
+            with self.update_lock:
+                state = self.state
+                songs = sorted((song for song in self._load_songs_by_path(list(file_paths))
+                                if int(song['id']) not in state.id_to_row), key=lambda song: song['id'])
+                if not songs:
+                    return
+                
+                # Small libraries are cheap to rebuild, which refreshes the scaler statistics
+                # and builds the approximate index once the library outgrows exact search.
+                # Replaced or deleted rows leave stale ids behind that cannot be removed in place.
+                if (len(state.meta) < HNSW_MIN_SONGS
+                        or self._count_indexable_songs() != len(state.meta) + len(songs)):
+                    self.rebuild_index()
+                    return
+                
+                for song in songs:
+                    self.add_song_to_index(song)
+        except Exception as e:
+            print(f"Error adding stored songs to index: {str(e)}")
+    
     def add_song_to_index(self, song_data):
         """Add a new song to the search index"""
+        with self.update_lock:
+            self._add_song(song_data)
+    
+    def _add_song(self, song_data):
+        """Append one song to every index array"""
         try:
-            # Parse fingerprint
-            fingerprint = self._parse_fingerprint(json.loads(song_data['fingerprint_data']))
-            
-            # Create feature vector
-            feature_vector = self.fingerprinter.create_feature_vector(fingerprint)
-            
-            # Add to indexed songs
-            self.indexed_songs.append({
-                'id': song_data['id'],
-                'file_path': song_data['file_path'],
-                'title': song_data['title'],
-                'artist': song_data['artist'],
-                'album': song_data['album'],
-                'tempo': song_data['tempo'],
-                'key': song_data['key_signature'],
-                'energy': song_data['energy'],
-                'fingerprint': fingerprint
-            })
-            
-            # Rebuild index if we have enough songs
-            if len(self.indexed_songs) % 100 == 0:  # Rebuild every 100 songs
-                songs = self._load_all_songs()
-                self._build_faiss_index(songs)
+            state = self.state
+            if state.features is None:
+                # First song: build the arrays from it
+                self._build_faiss_index([song_data])
+                return
+            
+            feature_vector = np.frombuffer(song_data['feature_vec'], dtype=np.float32)
+            row_number = len(state.features)
+            
+            # Searches still holding this state only look at its first row_number rows,
+            # so the shared metadata list and id map can grow in place
+            state.meta.append((
+                song_data['id'], song_data['file_path'], song_data['title'],
+                song_data['artist'], song_data['album'], song_data['key_signature']
+            ))
+            state.id_to_row[int(song_data['id'])] = row_number
+            
+            # Extend the checksums in the same id order a rebuild reads the songs in
+            self.content_hashes[0].update(np.int64(song_data['id']).tobytes())
+            self.content_hashes[1].update(song_data['feature_vec'])
+            
+            detail = self._build_detail_arrays(feature_vector.reshape(1, -1), [song_data['key_signature']])
+            grown = {name: self._append_rows(name, getattr(state, name), values)
+                     for name, values in zip(DETAIL_ARRAYS, detail)}
+            
+            # Scaled with the statistics frozen at the last rebuild
+            row = self._normalize_rows(self._scale(state, feature_vector).reshape(1, -1))
+            grown['simhash_codes'] = self._append_rows('simhash_codes', state.simhash_codes,
+                                                       self._simhash(row, state.simhash_planes))
+            grown['features'] = self._append_rows('features', state.features, row)
+            
+            if state.index is not None:
+                with self.faiss_lock:
+                    state.index.add_with_ids(row, np.array([song_data['id']], dtype=np.int64))
+                self.unsaved_additions += 1
+                if self.unsaved_additions >= INDEX_SAVE_INTERVAL:
+                    self._save_index(state.index, state.feature_mean, state.feature_inv_std)
+            
+            self.state = state._replace(**grown)
             
         except Exception as e:
             print(f"Error adding song to index: {str(e)}")
     
+    def _append_rows(self, name, array, rows):
+        """Append rows to an index array, growing its backing buffer geometrically"""
+        size = len(array)
+        buffer = self.row_buffers.get(name)
+        
+        # Arrays replaced by a rebuild are no longer views of their old buffer
+        if buffer is None or array.base is not buffer or len(buffer) < size + len(rows):
+            buffer = np.empty((max(2 * (size + len(rows)), 64),) + array.shape[1:], dtype=array.dtype)
+            buffer[:size] = array
+            self.row_buffers[name] = buffer
+        
+        # Rows past size are not part of any published state, so writing them is safe
+        buffer[size:size + len(rows)] = rows
+        return buffer[:size + len(rows)]
+    
     def rebuild_index(self):
         """Rebuild the entire search index"""
         try:
-            songs = self._load_all_songs()
-            self._build_faiss_index(songs)
+            with self.update_lock:
+                songs = self._load_all_songs()
+                self._build_faiss_index(songs)
             print("Search index rebuilt successfully")
         except Exception as e:
             print(f"Error rebuilding index: {str(e)}")
@@ -279,7 +624,21 @@ class SimilarityEngine:
     def get_index_stats(self):
         """Get statistics about the search index"""
         return {
-            'total_songs': len(self.indexed_songs),
+            'total_songs': len(self.state.meta),
             'feature_dimensions': self.feature_dim,
-            'index_type': 'FAISS IndexFlatIP' if self.index else 'None'
-        }
\ No newline at end of file
+            'index_type': self._index_type()
+        }
+    
+    def _index_type(self):
+        """Describe the index currently used for local search"""
+        state = self.state
+        if state.index is not None:
+            import faiss
+            if isinstance(faiss.downcast_index(state.index.index), faiss.IndexIVFPQ):
+                return 'FAISS IndexIVFPQ'
+            return 'FAISS IndexHNSWSQ (8-bit)'
+        if state.features is not None and len(state.features) >= HNSW_MIN_SONGS:
+            return 'SimHash prefilter'
+        if state.features is not None:
+            return 'Exact inner product'
+        return 'None'